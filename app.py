@@ -7,23 +7,39 @@ from passlib.hash import bcrypt
 from mangum import Mangum
 from dotenv import load_dotenv
 from sqlalchemy.orm import Session
+from sqlalchemy.exc import IntegrityError
 from fastapi.security import OAuth2PasswordRequestForm
-from fastapi import (FastAPI, Depends, HTTPException, UploadFile)
+from fastapi import (FastAPI, Depends, HTTPException, UploadFile, Response, Header)
 from fastapi.param_functions import File, Form
 from pydantic_models.schemas import (UserCreate, UserResponse, PostResponseUser,
                                      PostResponse, PostCreateImage, PostResponsePaginated,
-                                     Token)
+                                     Token, PostUploadRequest, PostUploadResponse,
+                                     PostConfirmUpload, PostSuggestion, PostPatch)
 load_dotenv()  # load environment variables
-from database.services import (get_db, get_user_email, # pylint: disable=wrong-import-position
+from database.services import (get_db, get_read_db, # pylint: disable=wrong-import-position
                                generate_jwt_token, is_valid_user,
                                get_user_by_token, get_image_path, save_post,
                                get_post, update_post, oauth2_scheme, verify_token,
-                               get_refresh_token, get_user, delete_refresh_token,
-                               add_presigned_url_to_post)
+                               get_user_with_refresh_token, rotate_refresh_token,
+                               delete_refresh_token, add_presigned_url_to_post,
+                               is_warm_up_event, warm_up_connections,
+                               generate_upload_url, verify_uploaded_image,
+                               suggest_titles, delete_user_post)
 from database.models import (User, Posts)  # pylint: disable=wrong-import-position
+from database.idempotency import (idempotency_scope, # pylint: disable=wrong-import-position
+                                  begin_idempotent_request, complete_idempotent_request,
+                                  release_idempotent_request)
 from database.database import create_tables  # pylint: disable=wrong-import-position
+from database.reaper import (run_task, REAPER_TASK, # pylint: disable=wrong-import-position
+                             RECONCILE_TASK)
+from middlewares.admission import AdmissionControlMiddleware # pylint: disable=wrong-import-position
+from middlewares.compression import CompressionMiddleware # pylint: disable=wrong-import-position
 
 app = FastAPI()
+# Separate concurrency budgets for uploads, auth and reads
+app.add_middleware(AdmissionControlMiddleware)
+# Gzip/brotli for big responses, Mangum send them base64 encoded to API Gateway
+app.add_middleware(CompressionMiddleware)
 
 # Create all tables
 # baseModel.metadata.create_all(bind=engine)
@@ -45,20 +61,18 @@ async def create_user(user:UserCreate, db: Session = Depends(get_db)) -> dict:
     """
         Api to register users.
     """
-    # Check if user exists
-    db_user = await get_user_email(user.email, db)
-
-    if db_user:
-        raise HTTPException(status_code=422, detail="Email already registered")
-    # Create the user
+    # Create the user, the email is normalized to lower case
     password_hash = bcrypt.hash(user.password)
-    user_model = User(name=user.name, email=user.email, last_name = user.last_name,
+    user_model = User(name=user.name, email=user.email.lower(), last_name = user.last_name,
                       password_hash = password_hash)
     try:
-        # Add user to the db
+        # Add user to the db, the unique index on the email tell us if exists
         db.add(user_model)
         db.flush()
-        db.refresh(user_model)
+    except IntegrityError as e:
+        db.rollback()
+        raise HTTPException(status_code=422, detail="Email already registered") from e
+    try:
         # Generate token and response
         token = await generate_jwt_token(user_model, db=db)
         # response
@@ -83,6 +97,7 @@ async def login_user(form_data: OAuth2PasswordRequestForm = Depends(),
     if not is_valid:
         raise HTTPException(401, user_db)
     token = await generate_jwt_token(user_db, db)
+    db.commit()
     return token
 
 @app.post('/api/refresh_token')
@@ -100,17 +115,18 @@ async def refresh_token(token:str = Depends(oauth2_scheme), db: Session = Depend
     user_id = payload.get('id')
     if user_id is None:
         raise credentials_exception
-    refresh_token_db = await get_refresh_token(user_id, db)
+    user_db, refresh_token_db = await get_user_with_refresh_token(user_id, db)
     # Validate that has the same token.
-    if refresh_token_db is None or refresh_token_db.refresh_token != token:
+    if user_db is None or refresh_token_db != token:
         raise credentials_exception
 
-    # Refresh the token on the database
-    user_db = await get_user(user_id, db)
-    new_token = await generate_jwt_token(user_db)
-    refresh_token_db.refresh_token = new_token["refresh_token"]
+    # Refresh the token on the database, fails if another request rotated it first
+    new_refresh_token = await rotate_refresh_token(user_db, token, db)
+    if new_refresh_token is None:
+        db.rollback()
+        raise credentials_exception
+    new_token = await generate_jwt_token(user_db, refresh_token=new_refresh_token)
     db.commit()
-    db.refresh(refresh_token_db)
     return new_token
 
 @app.get('/api/logout')
@@ -119,7 +135,7 @@ async def logout(user_response: UserResponse = Depends(get_user_by_token),
     """
         Delete the refresh_token from the user
     """
-    delete_refresh_token(user_response.id, db)
+    await delete_refresh_token(user_response.id, db)
     return {"message": "Logout sucessfull"}
 
 @app.get('/api/current_user', response_model=UserResponse)
@@ -133,49 +149,114 @@ async def get_current_user(user_response : UserResponse = Depends(get_user_by_to
 @app.post('/api/posts', response_model=PostResponse, status_code = 201)
 async def create_post(post_request: PostCreateImage,
                     user_response: UserResponse = Depends(get_current_user),
-                    db: Session = Depends(get_db)):
+                    db: Session = Depends(get_db),
+                    idempotency_key: str = Header(None)):
     """
-        Create post with image in str or image base 64
+        Create post with image in str or image base 64.
+        Retries with the same Idempotency-Key get the first response.
     """
+    key = idempotency_scope(idempotency_key, user_response.id, "POST /api/posts")
+    stored_response = await begin_idempotent_request(db, key)
+    if stored_response is not None:
+        response = PostResponse(**stored_response)
+        add_presigned_url_to_post(response)
+        return response.dict()
     image_str = post_request.image_str
     image_b64 = post_request.image_b64
-    image = await get_image_path(image_str, image_b64, None)
     try:
+        image = await get_image_path(image_str, image_b64, None)
         post_obj = Posts(**post_request.dict(exclude=["image_str", "image_b64"]),
                          user_id = user_response.id, image = image)
         post_obj = await save_post(post_obj, db)
         response = PostResponse.from_orm(post_obj)
+        complete_idempotent_request(db, key, response.dict())
+    except HTTPException:
+        db.rollback()
+        release_idempotent_request(db, key)
+        raise
     except Exception as e:
         db.rollback()
+        release_idempotent_request(db, key)
         raise HTTPException(422, f"Error {str(e)}") from e
     db.commit()
     add_presigned_url_to_post(response)
     return response.dict()
 
 @app.post("/api/posts/image-file")
-async def create_post_image_file(title: str = Form(...), content: str = Form(...),
+async def create_post_image_file(title: str = Form(...), content: str = Form(...), # pylint: disable=too-many-arguments
                     user_response: UserResponse = Depends(get_current_user),
                     db: Session = Depends(get_db),
-                    image_file: UploadFile = File(...)):
+                    image_file: UploadFile = File(...),
+                    idempotency_key: str = Header(None)):
     """
-        Save image with formData
+        Save image with formData.
+        Retries with the same Idempotency-Key get the first response.
     """
-    image = await get_image_path(None, None, image_file)
+    key = idempotency_scope(idempotency_key, user_response.id, "POST /api/posts/image-file")
+    stored_response = await begin_idempotent_request(db, key)
+    if stored_response is not None:
+        response = PostResponse(**stored_response)
+        add_presigned_url_to_post(response)
+        return response.dict()
     try:
+        image = await get_image_path(None, None, image_file)
         post_obj = Posts(title = title, content = content,
                           user_id = user_response.id, image = image)
         post_obj = await save_post(post_obj, db)
         response = PostResponse.from_orm(post_obj)
+        complete_idempotent_request(db, key, response.dict())
+    except HTTPException:
+        db.rollback()
+        release_idempotent_request(db, key)
+        raise
     except Exception as e:
         db.rollback()
+        release_idempotent_request(db, key)
         raise HTTPException(422, f"Error {str(e)}") from e
     db.commit()
     add_presigned_url_to_post(response)
     return response.dict()
 
+@app.post("/api/posts/upload-url", response_model=PostUploadResponse)
+async def create_upload_url(upload_request: PostUploadRequest,
+                            user_response: UserResponse = Depends(get_current_user)):
+    """
+        Get a presigned POST to upload the image directly to S3
+    """
+    return generate_upload_url(user_response.id, upload_request.content_type,
+                               upload_request.size)
+
+@app.post("/api/posts/confirm-upload", response_model=PostResponse, status_code = 201)
+async def confirm_upload(confirm_request: PostConfirmUpload, response: Response,
+                         user_response: UserResponse = Depends(get_current_user),
+                         db: Session = Depends(get_db)):
+    """
+        Attach the image uploaded to S3 to a new post, or to an existing
+        post when post_id is sent
+    """
+    image = verify_uploaded_image(user_response.id, confirm_request.key)
+    if confirm_request.post_id is not None:
+        params = confirm_request.dict(include={"title", "content"}, exclude_none=True)
+        post = await update_post(db, confirm_request.post_id, params, user_response, image)
+        response.status_code = 200
+    else:
+        if confirm_request.title is None or confirm_request.content is None:
+            raise HTTPException(422, "title and content are required for a new post")
+        try:
+            post = Posts(title = confirm_request.title, content = confirm_request.content,
+                         user_id = user_response.id, image = image)
+            post = await save_post(post, db)
+        except Exception as e:
+            db.rollback()
+            raise HTTPException(422, f"Error {str(e)}") from e
+        db.commit()
+    post_model = PostResponse.from_orm(post)
+    add_presigned_url_to_post(post_model)
+    return post_model
+
 @app.get("/api/posts", response_model=List[PostResponse])
 async def get_posts_user(user_response : UserResponse = Depends(get_current_user),
-                   db: Session = Depends(get_db)):
+                   db: Session = Depends(get_read_db)):
     """
         Get list of post by authenticate user.
     """
@@ -189,7 +270,7 @@ async def get_posts_user(user_response : UserResponse = Depends(get_current_user
     return response
 
 @app.get("/api/posts/{post_id}", response_model=PostResponseUser)
-async def get_post_detail(post_id: int, db: Session = Depends(get_db)):
+async def get_post_detail(post_id: int, db: Session = Depends(get_read_db)):
     """
         Get post details.
     """
@@ -238,6 +319,21 @@ async def edit_post_image_file(post_id: int, title: str = Form(...), # pylint: d
     add_presigned_url_to_post(post_model)
     return post_model
 
+@app.patch("/api/posts/{post_id}", response_model=PostResponse)
+async def patch_post(post_request: PostPatch, post_id: int,
+                     db: Session = Depends(get_db),
+                     user_response : UserResponse = Depends(get_current_user)):
+    """
+        Partial update of a post, only the fields sent are written
+    """
+    params = post_request.dict(exclude_unset=True)
+    image = await get_image_path(params.pop("image_str", None),
+                                 params.pop("image_b64", None), None)
+    post = await update_post(db, post_id, params, user_response, image)
+    post_model = PostResponse.from_orm(post)
+    add_presigned_url_to_post(post_model)
+    return post_model
+
 @app.delete("/api/posts/{post_id}")
 async def delete_post(post_id: int, db: Session = Depends(get_db),
                       user_response: UserResponse =
@@ -245,18 +341,22 @@ async def delete_post(post_id: int, db: Session = Depends(get_db),
     """
         Delete single post
     """
-    post = await get_post(db, None, post_id)
-    if not post:
-        raise HTTPException(404, "Post not found")
-    if post.user_id != user_response.id:
-        raise HTTPException(403, "Unathorized")
-    db.delete(post)
-    db.commit()
+    await delete_user_post(db, post_id, user_response)
     return "Post deleted"
 
+@app.get("/api/posts-suggest", response_model=List[PostSuggestion])
+async def get_posts_suggest(q: str, limit: int = 10, # pylint: disable=invalid-name
+                            db: Session = Depends(get_read_db)):
+    """
+        Autocomplete, titles of the posts that start with q
+    """
+    if len(q) == 0 or limit < 1 or limit > 50:
+        raise HTTPException(400, "q can't be empty and limit must be between 1 and 50")
+    return await suggest_titles(q, db, limit)
+
 @app.get("/api/posts-all", response_model=PostResponsePaginated)
 async def get_posts_all(page: int = 1, search: str = None,
-                   db: Session = Depends(get_db)):
+                   db: Session = Depends(get_read_db)):
     """
         Get all post available with pagination
     """
@@ -284,5 +384,20 @@ async def get_posts_all(page: int = 1, search: str = None,
     except Exception as e:
         print("Error", str(e))
         raise HTTPException(422, f"Error: {str(e)}") from e
-handler = Mangum(app)
+mangum_handler = Mangum(app)
+
+def handler(event, context):
+    """
+        Lambda entry point, keep-warm pings and the scheduled reaper tasks
+        are answered without going through the ASGI stack
+    """
+    if isinstance(event, dict) and event.get("task") in (REAPER_TASK, RECONCILE_TASK):
+        return run_task(event["task"], dry_run=event.get("dry_run", False))
+    if is_warm_up_event(event):
+        return warm_up_connections()
+    return mangum_handler(event, context)
+
+# Pre-initialize the connections on the lambda init phase
+if os.getenv("AWS_LAMBDA_FUNCTION_NAME") and os.getenv("LAMBDA_PREINIT", "1") == "1":
+    warm_up_connections()
 print('cargo')
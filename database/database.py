@@ -2,6 +2,7 @@
     This file contains the logic to create the database connection
 """
 import os
+import itertools
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
@@ -17,9 +18,26 @@ engine = create_engine(DB_URL)
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Optional read replicas, comma separated list of database urls
+DB_REPLICA_URLS = [url.strip() for url in os.getenv("DB_REPLICA_URLS", "").split(",")
+                   if url.strip()]
+replica_engines = [create_engine(url) for url in DB_REPLICA_URLS]
+ReplicaSessionLocal = [sessionmaker(autocommit=False, autoflush=False, bind=replica)
+                       for replica in replica_engines]
+_replica_cycle = itertools.cycle(ReplicaSessionLocal)
+
 baseModel = declarative_base()
 def create_tables():
     """
         Create the tables for the db
     """
     baseModel.metadata.create_all(bind=engine)
+
+def get_replica_session():
+    """
+        Get a session to one of the replicas (round robin), None if there
+        are no replicas configured
+    """
+    if not ReplicaSessionLocal:
+        return None
+    return next(_replica_cycle)()
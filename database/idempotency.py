@@ -0,0 +1,166 @@
+"""
+    This file contains the idempotency keys for the creation of posts. The
+    first response of a key is stored with a TTL and replayed to the retries,
+    a retry that arrives while the first request is running waits for it.
+"""
+import os
+import json
+import time
+import asyncio
+import threading
+from fastapi import HTTPException
+from sqlalchemy import delete, select, update
+from sqlalchemy.orm import Session
+from sqlalchemy.dialects.postgresql import insert
+from database.models import IdempotencyKey # pylint: disable=import-error, no-name-in-module
+
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", str(24 * 60 * 60)))
+# Seconds that a retry waits for the request in flight
+IDEMPOTENCY_WAIT_SECONDS = float(os.getenv("IDEMPOTENCY_WAIT_SECONDS", "10"))
+IDEMPOTENCY_POLL_SECONDS = 0.1
+IN_PROGRESS = "in_progress"
+DONE = "done"
+
+
+class DatabaseIdempotencyStore:
+    """
+        Keys saved on the idempotency_keys table
+    """
+    def claim(self, db: Session, key: str) -> bool:
+        """
+            Insert the key as in progress, False if it already exists.
+            The claim is committed so the retries can see it.
+        """
+        now = int(time.time())
+        # An expired key can be used again
+        db.execute(delete(IdempotencyKey).where(IdempotencyKey.key == key,
+                                                IdempotencyKey.expires_at < now))
+        stmt = insert(IdempotencyKey).values(
+            key = key, status = IN_PROGRESS, expires_at = now + IDEMPOTENCY_TTL
+        ).on_conflict_do_nothing(index_elements=[IdempotencyKey.key]).returning(
+            IdempotencyKey.key)
+        claimed = db.execute(stmt).scalar() is not None
+        db.commit()
+        return claimed
+
+    def get(self, db: Session, key: str):
+        """
+            Get the status and the response body of a key
+        """
+        row = db.execute(select(IdempotencyKey.status, IdempotencyKey.response_body).where(
+            IdempotencyKey.key == key)).first()
+        if row is None:
+            return None
+        return {"status": row[0], "response": json.loads(row[1]) if row[1] else None}
+
+    def complete(self, db: Session, key: str, response: dict):
+        """
+            Save the response, it is committed with the rest of the request
+        """
+        db.execute(update(IdempotencyKey).where(IdempotencyKey.key == key).values(
+            status = DONE, response_body = json.dumps(response, default=str)))
+
+    def release(self, db: Session, key: str):
+        """
+            Delete the key of a request that failed, so it can be retried
+        """
+        db.execute(delete(IdempotencyKey).where(IdempotencyKey.key == key))
+        db.commit()
+
+
+class MemoryIdempotencyStore:
+    """
+        Keys saved on the memory of the process, useful for tests and for a
+        single container
+    """
+    def __init__(self):
+        self._items = {}
+        self._lock = threading.Lock()
+
+    def claim(self, db: Session, key: str) -> bool: # pylint: disable=unused-argument
+        """
+            Save the key as in progress, False if it already exists
+        """
+        now = time.time()
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and item["expires_at"] >= now:
+                return False
+            self._items[key] = {"status": IN_PROGRESS, "response": None,
+                                "expires_at": now + IDEMPOTENCY_TTL}
+            return True
+
+    def get(self, db: Session, key: str): # pylint: disable=unused-argument
+        """
+            Get the status and the response of a key
+        """
+        item = self._items.get(key)
+        if item is None:
+            return None
+        return {"status": item["status"], "response": item["response"]}
+
+    def complete(self, db: Session, key: str, response: dict): # pylint: disable=unused-argument
+        """
+            Save the response of the key
+        """
+        with self._lock:
+            if key in self._items:
+                self._items[key].update(status = DONE, response = response)
+
+    def release(self, db: Session, key: str): # pylint: disable=unused-argument
+        """
+            Delete the key of a request that failed
+        """
+        with self._lock:
+            self._items.pop(key, None)
+
+
+STORES = {"database": DatabaseIdempotencyStore, "memory": MemoryIdempotencyStore}
+idempotency_store = STORES[os.getenv("IDEMPOTENCY_STORE", "database")]()
+
+
+def idempotency_scope(key: str, user_id: int, route: str):
+    """
+        Keys are unique by user and route, None if the client didn't send one
+    """
+    if not key:
+        return None
+    if len(key) > 255:
+        raise HTTPException(400, "Idempotency-Key is too long")
+    return f"{user_id}:{route}:{key}"
+
+
+async def begin_idempotent_request(db: Session, key: str):
+    """
+        Claim the key. Return None when this request must do the work, or the
+        stored response when a previous request already did it.
+    """
+    if key is None:
+        return None
+    deadline = time.monotonic() + IDEMPOTENCY_WAIT_SECONDS
+    while True:
+        if idempotency_store.claim(db, key):
+            return None
+        stored = idempotency_store.get(db, key)
+        if stored is not None and stored["status"] == DONE:
+            return stored["response"]
+        # The first request is still running, or it failed and released the key
+        if time.monotonic() > deadline:
+            raise HTTPException(409, "A request with this Idempotency-Key is in progress")
+        await asyncio.sleep(IDEMPOTENCY_POLL_SECONDS)
+
+
+def complete_idempotent_request(db: Session, key: str, response: dict):
+    """
+        Store the response of the request
+    """
+    if key is not None:
+        idempotency_store.complete(db, key, response)
+
+
+def release_idempotent_request(db: Session, key: str):
+    """
+        Free the key after an error
+    """
+    if key is not None:
+        idempotency_store.release(db, key)
@@ -5,7 +5,7 @@
 from datetime import datetime, timezone
 from passlib.hash import bcrypt
 from sqlalchemy.orm import relationship
-from sqlalchemy import (Column, Integer, String, ForeignKey)
+from sqlalchemy import (Column, Integer, String, Text, DateTime, ForeignKey, Index, func)
 from database.database import baseModel # pylint: disable=import-error, no-name-in-module
 
 
@@ -21,6 +21,8 @@ class User(baseModel): # pylint: disable=too-few-public-methods
     password_hash = Column(String)
     created_at = Column(String, default=datetime.utcnow())
     posts = relationship('Posts', back_populates='user')
+    # Lookups by email are case insensitive and use this index
+    __table_args__ = (Index('ix_users_email_lower', func.lower(email), unique=True),)
 
     def check_password(self, password:str) -> bool:
         """
@@ -41,6 +43,9 @@ class Posts(baseModel): # pylint: disable=too-few-public-methods
     created_at = Column(String, default=datetime.utcnow())
     # relationship
     user = relationship("User", back_populates='posts')
+    # Prefix searches on the title (LIKE 'prefix%') use this index
+    __table_args__ = (Index('ix_posts_title_lower', func.lower(title).label('title_lower'),
+                            postgresql_ops={'title_lower': 'text_pattern_ops'}),)
 
 class RefreshToken(baseModel): # pylint: disable=too-few-public-methods
     """
@@ -51,3 +56,26 @@ class RefreshToken(baseModel): # pylint: disable=too-few-public-methods
     refresh_token = Column(String, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), unique=True)
     created_at = Column(String, default=datetime.now(timezone.utc))
+
+class IdempotencyKey(baseModel): # pylint: disable=too-few-public-methods
+    """
+        Model for the idempotency keys of the requests that create posts
+    """
+    __tablename__ = 'idempotency_keys'
+    key = Column(String, primary_key=True)
+    status = Column(String)
+    response_body = Column(Text, nullable=True)
+    # Epoch seconds
+    expires_at = Column(Integer, index=True)
+
+class OrphanedImage(baseModel): # pylint: disable=too-few-public-methods
+    """
+        Model for the queue of images no longer used by a post, they are
+        deleted from the bucket in batches by the reaper
+    """
+    __tablename__ = 'orphaned_images'
+    id = Column(Integer, primary_key=True, index=True)
+    image = Column(String)
+    attempts = Column(Integer, default=0, server_default='0')
+    last_error = Column(String, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
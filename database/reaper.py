@@ -0,0 +1,166 @@
+"""
+    This file contains the reaper of the orphaned images. The images of the
+    deleted posts and the replaced images are saved on the orphaned_images
+    queue by the requests, the reaper delete them from the bucket in batches
+    with DeleteObjects.
+
+    Run it with a scheduled lambda event {"task": "reap_orphaned_images"} or
+    from the command line:
+        python -m database.reaper
+        python -m database.reaper --reconcile [--dry-run]
+"""
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from botocore.exceptions import ClientError
+from dotenv import load_dotenv
+from sqlalchemy.orm import Session
+load_dotenv()  # load environment variables when it runs from the command line
+from database.database import SessionLocal # pylint: disable=import-error, no-name-in-module, wrong-import-position
+from database.models import (Posts, OrphanedImage) # pylint: disable=import-error, no-name-in-module, wrong-import-position
+from database import services # pylint: disable=import-error, no-name-in-module, wrong-import-position
+
+# DeleteObjects accept up to 1000 keys per call
+REAPER_BATCH_SIZE = min(int(os.getenv("REAPER_BATCH_SIZE", "1000")), 1000)
+REAPER_MAX_ATTEMPTS = int(os.getenv("REAPER_MAX_ATTEMPTS", "5"))
+REAPER_RETRIES = 3
+# Objects younger than this are not reconciled, they can be direct uploads
+# waiting for the confirm step
+RECONCILE_GRACE_HOURS = int(os.getenv("RECONCILE_GRACE_HOURS", "24"))
+REAPER_TASK = "reap_orphaned_images"
+RECONCILE_TASK = "reconcile_images"
+
+
+def image_key(image: str):
+    """
+        Get the object key of an image saved on the bucket, None if the image
+        is not on the bucket
+    """
+    prefix = f"https://{services.BUCKET_NAME}.s3.amazonaws.com/"
+    if image is None or not image.startswith(prefix):
+        return None
+    return image.split('/')[-1]
+
+
+def delete_objects(keys: list, s3_client=None) -> dict:
+    """
+        Delete the keys with DeleteObjects, retrying the call with backoff.
+        Return the keys that failed with their error.
+    """
+    s3_client = s3_client or services.s3
+    for attempt in range(REAPER_RETRIES):
+        try:
+            response = s3_client.delete_objects(
+                Bucket=services.BUCKET_NAME,
+                Delete={"Objects": [{"Key": key} for key in keys], "Quiet": True})
+            return {error["Key"]: error.get("Message", error.get("Code"))
+                    for error in response.get("Errors", [])}
+        except ClientError as e:
+            if attempt == REAPER_RETRIES - 1:
+                return {key: str(e) for key in keys}
+            time.sleep(2 ** attempt * 0.5)
+    return {}
+
+
+def reap_batch(db: Session, s3_client=None, batch_size: int = REAPER_BATCH_SIZE) -> dict:
+    """
+        Delete one batch of the queue. The rows are locked with SKIP LOCKED so
+        several reapers can run at the same time.
+    """
+    metrics = {"deleted": 0, "failed": 0, "skipped": 0}
+    rows = db.query(OrphanedImage).filter(
+        OrphanedImage.attempts < REAPER_MAX_ATTEMPTS
+    ).order_by(OrphanedImage.id).limit(batch_size).with_for_update(skip_locked=True).all()
+    if not rows:
+        return metrics
+    # A key can be shared with another post (image-file uploads keep the filename)
+    images = {row.image for row in rows}
+    in_use = {image for (image,) in db.query(Posts.image).filter(Posts.image.in_(images))}
+    keys = {}
+    for row in rows:
+        key = image_key(row.image)
+        if key is None or row.image in in_use:
+            metrics["skipped"] += 1
+            db.delete(row)
+        else:
+            keys.setdefault(key, []).append(row)
+    errors = delete_objects(list(keys), s3_client) if keys else {}
+    for key, key_rows in keys.items():
+        for row in key_rows:
+            if key in errors:
+                metrics["failed"] += 1
+                row.attempts += 1
+                row.last_error = errors[key][:255]
+            else:
+                metrics["deleted"] += 1
+                db.delete(row)
+    db.commit()
+    metrics["batch_size"] = len(rows)
+    return metrics
+
+
+def reap_orphaned_images(db: Session, s3_client=None, batch_size: int = REAPER_BATCH_SIZE,
+                         max_batches: int = 100) -> dict:
+    """
+        Empty the queue in batches and return the metrics
+    """
+    metrics = {"batches": 0, "deleted": 0, "failed": 0, "skipped": 0}
+    started = time.monotonic()
+    for _ in range(max_batches):
+        batch = reap_batch(db, s3_client, batch_size)
+        if "batch_size" not in batch:
+            break
+        metrics["batches"] += 1
+        for name in ("deleted", "failed", "skipped"):
+            metrics[name] += batch[name]
+        if batch["batch_size"] < batch_size:
+            break
+    metrics["seconds"] = round(time.monotonic() - started, 3)
+    print('Reaper metrics', metrics)
+    return metrics
+
+
+def reconcile_images(db: Session, s3_client=None, dry_run: bool = False) -> dict:
+    """
+        Compare the keys on the bucket with the images of the posts and queue
+        the keys that no post uses
+    """
+    s3_client = s3_client or services.s3
+    referenced = {image_key(image) for (image,) in db.query(Posts.image).filter(
+        Posts.image.is_not(None))}
+    queued = {image_key(image) for (image,) in db.query(OrphanedImage.image)}
+    grace_limit = datetime.now(timezone.utc) - timedelta(hours=RECONCILE_GRACE_HOURS)
+    orphans = []
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=services.BUCKET_NAME):
+        for item in page.get("Contents", []):
+            key = item["Key"]
+            if key in referenced or key in queued or item["LastModified"] > grace_limit:
+                continue
+            orphans.append(key)
+    if not dry_run and orphans:
+        db.add_all([OrphanedImage(image=f"https://{services.BUCKET_NAME}.s3.amazonaws.com/{key}")
+                    for key in orphans])
+        db.commit()
+    metrics = {"orphans": len(orphans), "queued": 0 if dry_run else len(orphans)}
+    print('Reconcile metrics', metrics)
+    return metrics
+
+
+def run_task(task: str, dry_run: bool = False) -> dict:
+    """
+        Run a reaper task with a new session
+    """
+    db = SessionLocal()
+    try:
+        if task == RECONCILE_TASK:
+            return reconcile_images(db, dry_run=dry_run)
+        return reap_orphaned_images(db)
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    run_task(RECONCILE_TASK if "--reconcile" in sys.argv else REAPER_TASK,
+             dry_run="--dry-run" in sys.argv)
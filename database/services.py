@@ -2,6 +2,7 @@
     This file contains the business logic for the user and post
 """
 import os
+import time
 import base64
 import random
 import string
@@ -10,12 +11,19 @@ from datetime import (datetime, timedelta, timezone)
 import mimetypes
 import boto3
 import jwt
-from fastapi import  (Depends, HTTPException, UploadFile, Security)
+from botocore.exceptions import ClientError
+from fastapi import  (Depends, HTTPException, UploadFile, Security, Request, Response)
 from fastapi.security import (OAuth2PasswordBearer)
+from passlib.hash import bcrypt
+from sqlalchemy import (func, text, select, update, delete)
 from sqlalchemy.orm import (Session, joinedload)
+from sqlalchemy.dialects.postgresql import insert
 from database.database import (baseModel, # pylint: disable=import-error, no-name-in-module
-                               engine, SessionLocal)
-from database.models import (User, Posts, RefreshToken) # pylint: disable=import-error, no-name-in-module
+                               engine, SessionLocal, get_replica_session, replica_engines)
+from database.models import (User, Posts, RefreshToken, # pylint: disable=import-error, no-name-in-module
+                             OrphanedImage)
+from database.title_index import (title_index, # pylint: disable=import-error, no-name-in-module
+                                  record_title_change)
 
 from pydantic_models.schemas import (UserResponse, PostResponse)
 
@@ -27,10 +35,24 @@ oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/login")
 
 aws_access_key_id = os.getenv("AWS_ACCESS_KEY_FASTAPI")
 aws_secret_access_key = os.getenv("AWS_SECRET_ACCESS_KEY_FASTAPI")
+# S3_ENDPOINT_URL allow to use a local S3 stand-in
 s3 = boto3.client('s3', aws_access_key_id = aws_access_key_id,
-                  aws_secret_access_key=aws_secret_access_key)
+                  aws_secret_access_key=aws_secret_access_key,
+                  endpoint_url=os.getenv("S3_ENDPOINT_URL"))
 BUCKET_NAME = os.getenv("BUCKET_NAME")
+# Limits for the images uploaded directly to S3
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE", str(10 * 1024 * 1024)))
+UPLOAD_URL_EXPIRES = 900
+# Columns of a post that the owner can change
+POST_EDITABLE_FIELDS = ("title", "content", "image")
 REFRESH_TOKEN_EXPIRE_DAYS = 7
+# After a write the client reads from the primary during this window
+READ_YOUR_WRITES_SECONDS = int(os.getenv("DB_READ_YOUR_WRITES_SECONDS", "5"))
+PRIMARY_PIN_COOKIE = "db_primary_pin"
+
+# Sources of the scheduled events used to keep the lambda warm
+WARM_UP_SOURCES = ("aws.events", "serverless-plugin-warmup")
+WARM_UP_STATE = {"initialized": False}
 
 def create_db():
     """
@@ -39,16 +61,52 @@ def create_db():
     return baseModel.metadata.create_all(bind = engine)
 
 # Dependency to get the database session
-def get_db():
+def get_db(request: Request, response: Response):
     """
         Method to create a local session to the DB
     """
     db = SessionLocal()
+    if request.method not in ("GET", "HEAD"):
+        pin_to_primary(response)
     try:
         yield db
     finally:
         db.close()
 
+def pin_to_primary(response: Response):
+    """
+        Mark the client to read from the primary for a short window, so it can
+        read its own writes while the replicas catch up
+    """
+    pin_until = int(time.time()) + READ_YOUR_WRITES_SECONDS
+    response.set_cookie(PRIMARY_PIN_COOKIE, str(pin_until),
+                        max_age=READ_YOUR_WRITES_SECONDS, httponly=True)
+
+def is_pinned_to_primary(request: Request) -> bool:
+    """
+        Check if the client wrote recently
+    """
+    pin_until = request.cookies.get(PRIMARY_PIN_COOKIE)
+    try:
+        return pin_until is not None and int(pin_until) >= time.time()
+    except ValueError:
+        return False
+
+# Dependency to get the database session for read only endpoints
+def get_read_db(request: Request, db: Session = Depends(get_db)):
+    """
+        Session to a replica if there is one, fallback to the primary
+        session when there are no replicas or the client wrote recently
+    """
+    replica_db = None if is_pinned_to_primary(request) else get_replica_session()
+    if replica_db is None:
+        yield db
+        return
+    try:
+        yield replica_db
+    finally:
+        replica_db.close()
+
 async def get_user(user_id: int, db: Session) -> User:
     """
         Get the user id from the db
@@ -62,9 +120,19 @@ async def get_user_email(email:str, db: Session) -> User:
     """
         Method to get a user by email
     """
-    db_user = db.query(User).filter(User.email.ilike(email)).first()
+    db_user = db.query(User).filter(func.lower(User.email) == email.lower()).first()
     return db_user
 
+async def get_user_with_refresh_token(user_id: int, db: Session):
+    """
+        Get the user and his refresh token with a single query
+    """
+    row = db.query(User, RefreshToken.refresh_token).outerjoin(
+        RefreshToken, RefreshToken.user_id == User.id).filter(User.id == user_id).first()
+    if row is None:
+        return (None, None)
+    return (row[0], row[1])
+
 async def verify_token(token: str, credentials_exception):
     """
         Verify if is a valid token and is not expired
@@ -115,26 +183,42 @@ async def get_refresh_token(user_id: int, db: Session):
 
 async def get_or_create_refresh_token(user: User, db: Session):
     """
-        Function to get or create refresh token
+        Function to get or create refresh token in a single statement.
+        The caller is in charge of the commit.
     """
-    refresh_token_db = None
-    # Only one user per token, get the current user token if exists
-    # Feach the refresh token for this user
-    refresh_token_db = await get_refresh_token(user.id, db)
-    if refresh_token_db is None:
-        refresh_token = await encode_token(user, REFRESH_TOKEN_EXPIRE_DAYS * 60 * 24)
-        await save_refresh_token(user.id, refresh_token, db)
-    else:
-        refresh_token = refresh_token_db.refresh_token
-    return refresh_token
+    refresh_token = await encode_token(user, REFRESH_TOKEN_EXPIRE_DAYS * 60 * 24)
+    # Only one token per user, if exists keep the current one and return it
+    stmt = insert(RefreshToken).values(user_id = user.id, refresh_token = refresh_token)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[RefreshToken.user_id],
+        set_={'refresh_token': RefreshToken.refresh_token}
+    ).returning(RefreshToken.refresh_token)
+    return db.execute(stmt).scalar_one()
+
+async def rotate_refresh_token(user: User, current_token: str, db: Session):
+    """
+        Replace the refresh token of the user in a single statement, only if
+        the stored token is still current_token. Return None otherwise.
+        The caller is in charge of the commit.
+    """
+    refresh_token = await encode_token(user, REFRESH_TOKEN_EXPIRE_DAYS * 60 * 24)
+    stmt = insert(RefreshToken).values(user_id = user.id, refresh_token = refresh_token)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[RefreshToken.user_id],
+        set_={'refresh_token': stmt.excluded.refresh_token},
+        where=RefreshToken.refresh_token == current_token
+    ).returning(RefreshToken.refresh_token)
+    return db.execute(stmt).scalar()
 
-async def generate_jwt_token(user: User, db: Session = None) -> dict:
+async def generate_jwt_token(user: User, db: Session = None,
+                             refresh_token: str = None) -> dict:
     """
         Method to generate a jwt token
     """
     # Create token for this user
     token = await encode_token(user)
-    refresh_token = await get_or_create_refresh_token(user, db)
+    if refresh_token is None:
+        refresh_token = await get_or_create_refresh_token(user, db)
     return {"access_token": token, "token_type": "Bearer",
             "refresh_token": refresh_token}
 
@@ -142,10 +226,9 @@ async def delete_refresh_token(user_id: int, db: Session):
     """
         Delete the refresh token from the user
     """
-    db_token = db.query(RefreshToken).filter(RefreshToken.user_id == user_id).first()
-    if db_token:
-        db.delete(db_token)
-        db.commit()
+    db.query(RefreshToken).filter(RefreshToken.user_id == user_id).delete(
+        synchronize_session=False)
+    db.commit()
 
 async def is_valid_user(email:str, password:str, db: Session):
     """
@@ -187,13 +270,20 @@ async def get_extension_from_base64(base64_str: str):
     extension = mime_type.split("/")[-1]
     return extension
 
-async def get_image_path(image_str:str, image_b64:str, image_file: UploadFile):
+def generate_image_name() -> str:
     """
-        Get image path depends of the parameters
+        Random name for the images saved on the bucket
     """
     image_name = ""
     for _ in range(11):
         image_name += random.choice(string.ascii_lowercase)
+    return image_name
+
+async def get_image_path(image_str:str, image_b64:str, image_file: UploadFile):
+    """
+        Get image path depends of the parameters
+    """
+    image_name = generate_image_name()
 
     if image_str:
         return image_str
@@ -229,6 +319,43 @@ async def get_image_path(image_str:str, image_b64:str, image_file: UploadFile):
             raise HTTPException(400, f"Invalid image file {str(e)}") from e
     return None
 
+def generate_upload_url(user_id: int, content_type: str, size: int = None) -> dict:
+    """
+        Generate a presigned POST so the client upload the image directly to
+        the bucket. The key is chosen here and starts with the user id.
+    """
+    if not content_type.startswith('image/'):
+        raise HTTPException(400, "Only images can be uploaded")
+    if size is not None and size > MAX_UPLOAD_SIZE:
+        raise HTTPException(413, f"Image bigger than {MAX_UPLOAD_SIZE} bytes")
+    extension = content_type.split('/')[-1]
+    object_key = f"{user_id}-{generate_image_name()}.{extension}"
+    presigned = s3.generate_presigned_post(
+        Bucket=BUCKET_NAME,
+        Key=object_key,
+        Fields={'Content-Type': content_type},
+        Conditions=[{'Content-Type': content_type},
+                    ['content-length-range', 1, MAX_UPLOAD_SIZE]],
+        ExpiresIn=UPLOAD_URL_EXPIRES)
+    return {"url": presigned["url"], "fields": presigned["fields"],
+            "key": object_key, "expires_in": UPLOAD_URL_EXPIRES}
+
+def verify_uploaded_image(user_id: int, object_key: str) -> str:
+    """
+        Check with a HEAD that the image uploaded by the user exists on the
+        bucket and return the image path to save on the post
+    """
+    if not object_key.startswith(f"{user_id}-") or '/' in object_key:
+        raise HTTPException(403, "Unathorized")
+    try:
+        head = s3.head_object(Bucket=BUCKET_NAME, Key=object_key)
+    except ClientError as e:
+        raise HTTPException(404, "Uploaded image not found") from e
+    if (head.get('ContentLength', 0) > MAX_UPLOAD_SIZE
+            or not head.get('ContentType', '').startswith('image/')):
+        raise HTTPException(400, "Invalid uploaded image")
+    return f"https://{BUCKET_NAME}.s3.amazonaws.com/{object_key}"
+
 def generate_signed_url(object_key:str,exp:int = 3600):
     """
         Generate a signed url for the bucket
@@ -256,6 +383,7 @@ async def save_post(post: Posts, db: Session):
     db.add(post)
     db.flush()
     db.refresh(post)
+    record_title_change(db, post.id, post.title)
     return post
 
 async def get_post(db: Session, user_id: int, post_id: int = None):
@@ -271,28 +399,138 @@ async def get_post(db: Session, user_id: int, post_id: int = None):
 async def update_post(db: Session, post_id: int, params: dict,
                      user_response: UserResponse ,image = None):
     """
-        Function to update a post.
+        Function to update a post with a single UPDATE ... RETURNING, only
+        the columns on params are written. A replaced image is queued for
+        deletion on the same statement.
     """
-    post = await get_post(db, None, post_id = post_id)
-    if not post:
-        raise HTTPException(404, "post not found")
+    values = {field: value for field, value in params.items()
+              if field in POST_EDITABLE_FIELDS}
+    if image is not None:
+        values["image"] = image
+    posts = Posts.__table__
     # Only the user who made the post can edit it
-    user_id = user_response.id
-    if user_id != post.user_id:
-        raise HTTPException(403, "Unathorized")
-    for field, value in params.items():
-        if hasattr(post, field):
-            setattr(post, field, value)
-        if image is not None:
-            post.image = image
+    condition = (posts.c.id == post_id, posts.c.user_id == user_response.id)
+    if "image" in values:
+        stmt = update_post_queue_old_image(condition, values)
+    elif values:
+        stmt = update(posts).where(*condition).values(**values).returning(*posts.c)
+    else:
+        stmt = select(*posts.c).where(*condition)
+    post = db.execute(stmt).first()
+    if post is None:
+        raise_post_not_found_or_forbidden(db, post_id)
+    if "title" in values:
+        record_title_change(db, post.id, post.title)
     # Commit to db
     db.commit()
-    db.refresh(post)
     return post
 
+def update_post_queue_old_image(condition: tuple, values: dict):
+    """
+        UPDATE ... RETURNING that also insert the previous image of the post
+        on the orphaned_images queue when it changes
+    """
+    posts = Posts.__table__
+    old_post = select(posts.c.id, posts.c.image).where(*condition).with_for_update().cte(
+        "old_post")
+    updated_post = update(posts).where(posts.c.id == old_post.c.id).values(**values).returning(
+        *posts.c, old_post.c.image.label("old_image")).cte("updated_post")
+    queued_image = insert(OrphanedImage).from_select(
+        ["image"], select(updated_post.c.old_image).where(
+            updated_post.c.old_image.is_not(None),
+            updated_post.c.old_image != updated_post.c.image)).cte("queued_image")
+    return select(*[updated_post.c[column.name] for column in posts.c]).add_cte(queued_image)
+
+async def delete_user_post(db: Session, post_id: int, user_response: UserResponse):
+    """
+        Function to delete a post of the user with a single DELETE ... RETURNING,
+        the image of the post is queued for deletion on the same statement
+    """
+    deleted_post = delete(Posts).where(
+        Posts.id == post_id, Posts.user_id == user_response.id
+    ).returning(Posts.id, Posts.image).cte("deleted_post")
+    queued_image = insert(OrphanedImage).from_select(
+        ["image"], select(deleted_post.c.image).where(deleted_post.c.image.is_not(None))
+    ).cte("queued_image")
+    stmt = select(deleted_post.c.id).add_cte(queued_image)
+    deleted_id = db.execute(stmt).scalar_one_or_none()
+    if deleted_id is None:
+        raise_post_not_found_or_forbidden(db, post_id)
+    record_title_change(db, deleted_id)
+    db.commit()
+    return deleted_id
+
+def raise_post_not_found_or_forbidden(db: Session, post_id: int):
+    """
+        The write matched no row, find if the post doesn't exist or belongs
+        to another user
+    """
+    if db.query(Posts.id).filter(Posts.id == post_id).first() is None:
+        raise HTTPException(404, "post not found")
+    raise HTTPException(403, "Unathorized")
+
+async def suggest_titles(prefix: str, db: Session, limit: int = 10) -> list:
+    """
+        Get the id and title of the posts whose title starts with the prefix.
+        Served from the in-memory index, the database is used while the
+        index can't be built.
+    """
+    if title_index.needs_build():
+        # One row more than the maximum tell us if the index would be too big
+        title_index.build(db.query(Posts.id, Posts.title).limit(title_index.max_size + 1).all())
+    if title_index.is_built:
+        rows = title_index.search(prefix, limit)
+    else:
+        escaped = prefix.lower().replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        rows = db.query(Posts.id, Posts.title).filter(
+            func.lower(Posts.title).like(f"{escaped}%", escape='\\')).order_by(
+            func.lower(Posts.title)).limit(limit).all()
+    return [{"id": post_id, "title": title} for post_id, title in rows]
+
 async def serializer_post(post: Posts):
     """
         Function to serialize a post
     """
     post_app = PostResponse.from_orm(post)
     return post_app.dict()
+
+def is_warm_up_event(event) -> bool:
+    """
+        Check if the lambda event is a keep-warm ping
+    """
+    if not isinstance(event, dict):
+        return False
+    return event.get("source") in WARM_UP_SOURCES or event.get("warmer") is True
+
+def warm_up_connections() -> dict:
+    """
+        Open the database connections, the S3 connection and load the JWT and
+        bcrypt backends. Only the first call does the work, so it can run on
+        the lambda init phase and on every warm-up event.
+    """
+    if WARM_UP_STATE["initialized"]:
+        return {"warm": True, "initialized": False}
+    errors = []
+    # The connections stay open on the pool
+    for db_engine in [engine, *replica_engines]:
+        try:
+            with db_engine.connect() as connection:
+                connection.execute(text("SELECT 1"))
+        except Exception as e: # pylint: disable=broad-exception-caught
+            errors.append(f"database: {str(e)}")
+    try:
+        if BUCKET_NAME:
+            s3.head_bucket(Bucket=BUCKET_NAME)
+    except Exception as e: # pylint: disable=broad-exception-caught
+        errors.append(f"s3: {str(e)}")
+    try:
+        jwt.encode({"warm": True}, SECRET_JWT or "warm-up", algorithm="HS256")
+        bcrypt.get_backend()
+    except Exception as e: # pylint: disable=broad-exception-caught
+        errors.append(f"auth: {str(e)}")
+    if errors:
+        # Try again on the next warm-up event
+        print('Warm up errors', errors)
+    else:
+        WARM_UP_STATE["initialized"] = True
+    return {"warm": True, "initialized": True, "errors": errors}
@@ -0,0 +1,144 @@
+"""
+    This file contains the in-memory prefix index of the post titles used by
+    the autocomplete. It is built lazily from the database and updated when the
+    sessions that save, update or delete a post are committed.
+"""
+import os
+import time
+import bisect
+import threading
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+# Seconds before rebuilding, other containers may have changed the titles
+TITLE_INDEX_TTL = int(os.getenv("TITLE_INDEX_TTL", "300"))
+# Above this number of posts the database index is used instead
+TITLE_INDEX_MAX_SIZE = int(os.getenv("TITLE_INDEX_MAX_SIZE", "100000"))
+PENDING_KEY = "title_index_changes"
+
+
+class TitleIndex:
+    """
+        Sorted array of (lower case title, post id) searched with bisect
+    """
+    def __init__(self, ttl: int = TITLE_INDEX_TTL, max_size: int = TITLE_INDEX_MAX_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.built_at = None
+        self.checked_at = None
+        self._keys = []
+        self._titles = {}
+        self._lock = threading.Lock()
+
+    def needs_build(self) -> bool:
+        """
+            Check if the index was never built or is expired
+        """
+        return self.checked_at is None or time.monotonic() - self.checked_at > self.ttl
+
+    @property
+    def is_built(self) -> bool:
+        """
+            Check if the index can be used for searches
+        """
+        return self.built_at is not None
+
+    def build(self, rows) -> bool:
+        """
+            Build the index with (post id, title) rows. Return False when
+            there are too many posts to keep them in memory.
+        """
+        titles = {post_id: title for post_id, title in rows if title is not None}
+        with self._lock:
+            self.checked_at = time.monotonic()
+            if len(titles) > self.max_size:
+                self._keys = []
+                self._titles = {}
+                self.built_at = None
+                return False
+            self._titles = titles
+            self._keys = sorted((title.lower(), post_id) for post_id, title in titles.items())
+            self.built_at = self.checked_at
+        return True
+
+    def clear(self):
+        """
+            Drop the index, it will be built again on the next search
+        """
+        with self._lock:
+            self._keys = []
+            self._titles = {}
+            self.built_at = None
+            self.checked_at = None
+
+    def add(self, post_id: int, title: str):
+        """
+            Add or replace the title of a post
+        """
+        with self._lock:
+            if self.built_at is None:
+                return
+            self._remove(post_id)
+            if title is None:
+                return
+            self._titles[post_id] = title
+            bisect.insort(self._keys, (title.lower(), post_id))
+
+    def remove(self, post_id: int):
+        """
+            Remove a post from the index
+        """
+        with self._lock:
+            self._remove(post_id)
+
+    def _remove(self, post_id: int):
+        title = self._titles.pop(post_id, None)
+        if title is None:
+            return
+        position = bisect.bisect_left(self._keys, (title.lower(), post_id))
+        if position < len(self._keys) and self._keys[position] == (title.lower(), post_id):
+            del self._keys[position]
+
+    def search(self, prefix: str, limit: int = 10) -> list:
+        """
+            Get the first (post id, title) whose title starts with the prefix
+        """
+        prefix = prefix.lower()
+        position = bisect.bisect_left(self._keys, (prefix,))
+        result = []
+        for key, post_id in self._keys[position:position + limit]:
+            if not key.startswith(prefix):
+                break
+            result.append((post_id, self._titles[post_id]))
+        return result
+
+
+title_index = TitleIndex()
+
+
+def record_title_change(db: Session, post_id: int, title: str = None):
+    """
+        Save the change of a title on the session, it is applied to the index
+        when the session is committed. A title None means the post was deleted.
+    """
+    db.info.setdefault(PENDING_KEY, []).append((post_id, title))
+
+
+@event.listens_for(Session, "after_commit")
+def apply_title_changes(session: Session):
+    """
+        Apply the title changes of the committed session to the index
+    """
+    for post_id, title in session.info.pop(PENDING_KEY, []):
+        if title is None:
+            title_index.remove(post_id)
+        else:
+            title_index.add(post_id, title)
+
+
+@event.listens_for(Session, "after_rollback")
+def discard_title_changes(session: Session):
+    """
+        Forget the title changes of a session rolled back
+    """
+    session.info.pop(PENDING_KEY, None)
@@ -0,0 +1,148 @@
+"""
+    This file contains the admission control for the api. Each class of route
+    (uploads, auth and reads) has its own concurrency budget with a bounded
+    wait queue, when the budget is saturated the request is rejected with 503.
+"""
+import os
+import asyncio
+from collections import deque
+from fastapi.responses import JSONResponse
+
+UPLOADS = "uploads"
+AUTH = "auth"
+READS = "reads"
+
+# Routes that receive image bodies and talk to S3
+UPLOAD_ROUTES = {('POST', '/api/posts'), ('POST', '/api/posts/image-file')}
+# Routes that run bcrypt or sign tokens
+AUTH_ROUTES = {('POST', '/api/login'), ('POST', '/api/register'),
+               ('POST', '/api/refresh_token')}
+
+# limit, queue size, seconds waiting in the queue, retry after
+DEFAULT_BUDGETS = {
+    UPLOADS: (4, 8, 5.0, 5),
+    AUTH: (8, 16, 2.0, 1),
+    READS: (64, 128, 1.0, 1),
+}
+
+
+class ConcurrencyBudget:
+    """
+        Concurrency limiter with a bounded queue of waiters
+    """
+    def __init__(self, name: str, limit: int, max_queue: int = 0,
+                 timeout: float = 1.0, retry_after: int = 1):
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.active = 0
+        self.rejected = 0
+        self._waiters = deque()
+
+    @property
+    def waiting(self) -> int:
+        """
+            Number of requests waiting for a slot
+        """
+        return len(self._waiters)
+
+    async def acquire(self) -> bool:
+        """
+            Take a slot, wait on the queue if there is room on it.
+            Return False when the request must be shed.
+        """
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return True
+        if len(self._waiters) >= self.max_queue:
+            self.rejected += 1
+            return False
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, self.timeout)
+        except asyncio.TimeoutError:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+            self.rejected += 1
+            return False
+        # The slot was handed over by release, active is already counted
+        return True
+
+    def release(self):
+        """
+            Give the slot to the next waiter or free it
+        """
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(True)
+                return
+        self.active -= 1
+
+
+def classify_request(method: str, path: str):
+    """
+        Get the route class of a request
+    """
+    path = path.rstrip('/') or '/'
+    if (method, path) in UPLOAD_ROUTES:
+        return UPLOADS
+    # Edit endpoints: /api/posts/{post_id} and /api/posts/{post_id}/image-file
+    if method in ('PUT', 'PATCH') and path.startswith('/api/posts/'):
+        return UPLOADS
+    if (method, path) in AUTH_ROUTES:
+        return AUTH
+    if method in ('GET', 'HEAD'):
+        return READS
+    return None
+
+
+def budgets_from_env() -> dict:
+    """
+        Build the budgets with the environment variables, for example
+        ADMISSION_UPLOADS_LIMIT, ADMISSION_UPLOADS_QUEUE, ADMISSION_UPLOADS_TIMEOUT
+        and ADMISSION_UPLOADS_RETRY_AFTER. A limit of 0 disable the budget.
+    """
+    budgets = {}
+    for name, (limit, max_queue, timeout, retry_after) in DEFAULT_BUDGETS.items():
+        prefix = f"ADMISSION_{name.upper()}"
+        limit = int(os.getenv(f"{prefix}_LIMIT", str(limit)))
+        if limit <= 0:
+            continue
+        budgets[name] = ConcurrencyBudget(
+            name, limit,
+            max_queue=int(os.getenv(f"{prefix}_QUEUE", str(max_queue))),
+            timeout=float(os.getenv(f"{prefix}_TIMEOUT", str(timeout))),
+            retry_after=int(os.getenv(f"{prefix}_RETRY_AFTER", str(retry_after))))
+    return budgets
+
+
+class AdmissionControlMiddleware: # pylint: disable=too-few-public-methods
+    """
+        ASGI middleware that apply the budget of each route class
+    """
+    def __init__(self, app, budgets: dict = None):
+        self.app = app
+        self.budgets = budgets_from_env() if budgets is None else budgets
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        budget = self.budgets.get(classify_request(scope["method"], scope["path"]))
+        if budget is None:
+            await self.app(scope, receive, send)
+            return
+        if not await budget.acquire():
+            response = JSONResponse({"detail": "Server busy, try again later"},
+                                    status_code=503,
+                                    headers={"Retry-After": str(budget.retry_after)})
+            await response(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            budget.release()
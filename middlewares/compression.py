@@ -0,0 +1,128 @@
+"""
+    This file contains the response compression for the api. The body is
+    compressed with brotli or gzip when the client accepts it and it is bigger
+    than the minimum size. Compressed bodies are cached, so the same response
+    served again is not compressed twice.
+"""
+import os
+import gzip
+import hashlib
+from collections import OrderedDict
+from starlette.datastructures import Headers, MutableHeaders
+try:
+    import brotli
+except ImportError: # brotli is optional, only gzip is offered without it
+    brotli = None
+
+MINIMUM_SIZE = int(os.getenv("COMPRESSION_MINIMUM_SIZE", "1024"))
+CACHE_SIZE = int(os.getenv("COMPRESSION_CACHE_SIZE", "256"))
+COMPRESSIBLE_TYPES = ("application/json", "text/", "application/javascript")
+
+
+def choose_encoding(accept_encoding: str):
+    """
+        Get the best encoding accepted by the client, None if there is no one
+    """
+    accepted = {}
+    for item in accept_encoding.lower().split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip()] = quality
+    if brotli is not None and accepted.get("br", 0) > 0:
+        return "br"
+    if accepted.get("gzip", 0) > 0:
+        return "gzip"
+    return None
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    """
+        Compress the body with the encoding
+    """
+    if encoding == "br":
+        return brotli.compress(body, quality=4)
+    return gzip.compress(body, compresslevel=6, mtime=0)
+
+
+class CompressedBodyCache:
+    """
+        LRU cache of compressed bodies, the key is the digest of the raw body
+    """
+    def __init__(self, max_size: int = CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+
+    def get_or_compress(self, body: bytes, encoding: str) -> bytes:
+        """
+            Get the compressed body from the cache or compress it
+        """
+        if self.max_size <= 0:
+            return compress(body, encoding)
+        key = (encoding, hashlib.blake2b(body, digest_size=16).digest())
+        compressed = self._items.get(key)
+        if compressed is not None:
+            self.hits += 1
+            self._items.move_to_end(key)
+            return compressed
+        self.misses += 1
+        compressed = compress(body, encoding)
+        self._items[key] = compressed
+        if len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+        return compressed
+
+
+class CompressionMiddleware: # pylint: disable=too-few-public-methods
+    """
+        ASGI middleware to compress the responses
+    """
+    def __init__(self, app, minimum_size: int = MINIMUM_SIZE,
+                 cache: CompressedBodyCache = None):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.cache = CompressedBodyCache() if cache is None else cache
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = choose_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        start_message = None
+
+        async def send_compressed(message):
+            nonlocal start_message
+            if message["type"] == "http.response.start":
+                start_message = message
+                return
+            if start_message is None:
+                # Streaming response, the start was already sent
+                await send(message)
+                return
+            start, start_message = start_message, None
+            body = message.get("body", b"")
+            headers = MutableHeaders(raw=start["headers"])
+            content_type = headers.get("content-type", "")
+            if (message.get("more_body", False) or len(body) < self.minimum_size
+                    or "content-encoding" in headers
+                    or not content_type.startswith(COMPRESSIBLE_TYPES)):
+                await send(start)
+                await send(message)
+                return
+            compressed = self.cache.get_or_compress(body, encoding)
+            headers["Content-Encoding"] = encoding
+            headers["Content-Length"] = str(len(compressed))
+            headers.add_vary_header("Accept-Encoding")
+            await send(start)
+            await send({"type": "http.response.body", "body": compressed})
+
+        await self.app(scope, receive, send_compressed)
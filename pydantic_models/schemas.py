@@ -1,7 +1,7 @@
 """
     Pydanctic models for users, post and tokens
 """
-from typing import Optional, List
+from typing import Optional, List, Dict
 from datetime import datetime
 from pydantic import BaseModel, EmailStr
 
@@ -63,6 +63,40 @@ class PostCreateImage(PostsBase): # pylint: disable=too-few-public-methods
     image_str:Optional[str] = None
     image_b64: Optional[str] = None
 
+class PostPatch(BaseModel): # pylint: disable=too-few-public-methods
+    """
+        Partial update of a post, only the fields sent are changed
+    """
+    title: Optional[str] = None
+    content: Optional[str] = None
+    image_str: Optional[str] = None
+    image_b64: Optional[str] = None
+
+class PostUploadRequest(BaseModel): # pylint: disable=too-few-public-methods
+    """
+        Request a presigned url to upload an image directly to S3
+    """
+    content_type: str
+    size: Optional[int] = None
+
+class PostUploadResponse(BaseModel): # pylint: disable=too-few-public-methods
+    """
+        Presigned POST to upload the image, the fields goes on the form data
+    """
+    url: str
+    fields: Dict[str, str]
+    key: str
+    expires_in: int
+
+class PostConfirmUpload(BaseModel): # pylint: disable=too-few-public-methods
+    """
+        Attach an uploaded image to a new post or to an existing one
+    """
+    key: str
+    post_id: Optional[int] = None
+    title: Optional[str] = None
+    content: Optional[str] = None
+
 class PostResponse(PostsBase): # pylint: disable=too-few-public-methods
     """
         Post response
@@ -84,6 +118,13 @@ class PostResponseUser(PostResponse): # pylint: disable=too-few-public-methods
     """
     user: UserResponse
 
+class PostSuggestion(BaseModel): # pylint: disable=too-few-public-methods
+    """
+        Title suggested by the autocomplete
+    """
+    id: int
+    title: str
+
 class ResponsePaginated(BaseModel): # pylint: disable=too-few-public-methods
     """
         Response paginated
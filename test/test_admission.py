@@ -0,0 +1,55 @@
+"""
+    Test for the admission control middleware
+"""
+import asyncio
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from middlewares.admission import (ConcurrencyBudget, AdmissionControlMiddleware,
+                                   classify_request, UPLOADS, AUTH, READS)
+
+
+def test_classify_request():
+    assert classify_request('POST', '/api/posts') == UPLOADS
+    assert classify_request('POST', '/api/posts/image-file') == UPLOADS
+    assert classify_request('PUT', '/api/posts/3/image-file') == UPLOADS
+    assert classify_request('POST', '/api/login') == AUTH
+    assert classify_request('GET', '/api/posts-all') == READS
+    assert classify_request('DELETE', '/api/posts/3') is None
+
+
+def test_budget_queue_and_shed():
+    async def scenario():
+        budget = ConcurrencyBudget('test', limit=1, max_queue=1, timeout=0.05)
+        assert await budget.acquire()
+        # One request can wait, the queue is full for the next one
+        waiter = asyncio.ensure_future(budget.acquire())
+        await asyncio.sleep(0)
+        assert budget.waiting == 1
+        assert not await budget.acquire()
+        budget.release()
+        assert await waiter
+        assert budget.active == 1
+        # Timeout waiting on the queue
+        assert not await budget.acquire()
+        budget.release()
+        assert budget.active == 0
+        assert budget.rejected == 2
+    asyncio.run(scenario())
+
+
+def test_middleware_returns_503():
+    test_app = FastAPI()
+
+    @test_app.get('/api/posts-all')
+    async def posts_all():
+        return {"msg": "ok"}
+
+    budget = ConcurrencyBudget(READS, limit=1, max_queue=0, retry_after=7)
+    test_app.add_middleware(AdmissionControlMiddleware, budgets={READS: budget})
+    client = TestClient(test_app)
+    assert client.get('/api/posts-all').status_code == 200
+    # Saturate the budget
+    budget.active = 1
+    resp = client.get('/api/posts-all')
+    assert resp.status_code == 503
+    assert resp.headers['Retry-After'] == '7'
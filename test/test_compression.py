@@ -0,0 +1,47 @@
+"""
+    Test for the response compression middleware
+"""
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from middlewares.compression import (CompressionMiddleware, CompressedBodyCache,
+                                     choose_encoding)
+
+cache = CompressedBodyCache(max_size=4)
+test_app = FastAPI()
+test_app.add_middleware(CompressionMiddleware, minimum_size=500, cache=cache)
+
+@test_app.get('/big')
+async def big():
+    return {"content": "some content " * 100}
+
+@test_app.get('/small')
+async def small():
+    return {"content": "small"}
+
+client = TestClient(test_app)
+
+
+def test_choose_encoding():
+    assert choose_encoding('gzip, deflate') == 'gzip'
+    assert choose_encoding('gzip;q=0, identity') is None
+    assert choose_encoding('') is None
+
+
+def test_compress_big_response_and_reuse_cache():
+    resp = client.get('/big', headers={'Accept-Encoding': 'gzip'})
+    assert resp.status_code == 200
+    assert resp.headers['content-encoding'] == 'gzip'
+    assert 'Accept-Encoding' in resp.headers['vary']
+    assert resp.json() == {"content": "some content " * 100}
+    misses = cache.misses
+    resp = client.get('/big', headers={'Accept-Encoding': 'gzip'})
+    assert resp.headers['content-encoding'] == 'gzip'
+    assert cache.misses == misses
+    assert cache.hits >= 1
+
+
+def test_small_response_not_compressed():
+    resp = client.get('/small', headers={'Accept-Encoding': 'gzip'})
+    assert 'content-encoding' not in resp.headers
+    resp = client.get('/big', headers={'Accept-Encoding': 'identity'})
+    assert 'content-encoding' not in resp.headers
@@ -41,3 +41,20 @@ def test_create_user(db_session):
     data['email'] = 'valid@email.com'
     resp = client.post('/api/register', json=data)
     assert resp.status_code == 201
+
+def test_login_and_refresh_token(db_session):
+    data = {'name': 'something', 'last_name': 'something',
+            'password': 'test124.23', 'email': 'Login@Email.com'}
+    resp = client.post('/api/register', json=data)
+    assert resp.status_code == 201
+    # Emails are case insensitive
+    data['email'] = 'login@email.com'
+    resp = client.post('/api/register', json=data)
+    assert resp.status_code == 422
+    resp = client.post('/api/login', data={'username': 'LOGIN@email.com',
+                                           'password': 'test124.23'})
+    assert resp.status_code == 200
+    refresh = resp.json()['refresh_token']
+    resp = client.post('/api/refresh_token', headers={'Authorization': f'Bearer {refresh}'})
+    assert resp.status_code == 200
+    assert 'refresh_token' in resp.json()
@@ -1,9 +1,12 @@
 """
     test for posts
 """
+from botocore.exceptions import ClientError
+from database import services
 from database.services import (get_db, get_user_by_token)
 from test.utils import *
-from database.models import Posts
+from database.models import (Posts, User)
+from database.title_index import title_index
 from app import app
 
 app.dependency_overrides[get_db] = override_get_db
@@ -66,4 +69,90 @@ def test_delete_post(initial_state):
 def test_delete_post(initial_state):
     post_id = 1111
     resp = client.delete(f'/api/posts/{post_id}')
-    assert resp.status_code == 404
\ No newline at end of file
+    assert resp.status_code == 404
+
+class FakeS3:
+    """
+        Local stand-in for the S3 client
+    """
+    def __init__(self):
+        self.objects = {}
+
+    def generate_presigned_post(self, Bucket, Key, Fields, Conditions, ExpiresIn):
+        return {"url": f"https://{Bucket}.s3.amazonaws.com/", "fields": {**Fields, "key": Key}}
+
+    def head_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise ClientError({"Error": {"Code": "404"}}, "HeadObject")
+        return self.objects[Key]
+
+    def generate_presigned_url(self, ClientMethod, Params, ExpiresIn):
+        return f"https://signed/{Params['Key']}"
+
+
+def test_direct_upload_and_confirm(initial_state, monkeypatch):
+    fake_s3 = FakeS3()
+    monkeypatch.setattr(services, 's3', fake_s3)
+    resp = client.post('/api/posts/upload-url', json={'content_type': 'image/png'})
+    assert resp.status_code == 200
+    key = resp.json()['key']
+    assert resp.json()['fields']['key'] == key
+    data = {'key': key, 'title': 'direct upload', 'content': 'some content'}
+    # The image is not on the bucket yet
+    resp = client.post('/api/posts/confirm-upload', json=data)
+    assert resp.status_code == 404
+    fake_s3.objects[key] = {'ContentLength': 10, 'ContentType': 'image/png'}
+    resp = client.post('/api/posts/confirm-upload', json=data)
+    assert resp.status_code == 201
+    assert resp.json()['title'] == data['title']
+    # Attach to an existing post
+    resp = client.post('/api/posts/confirm-upload',
+                       json={'key': key, 'post_id': initial_state.id})
+    assert resp.status_code == 200
+    assert resp.json()['title'] == initial_state.title
+
+def test_posts_suggest(initial_state):
+    # The fixtures write to the tables without going through the index
+    title_index.clear()
+    resp = client.get('/api/posts-suggest', params={'q': 'EXAMPLE'})
+    assert resp.status_code == 200
+    assert resp.json() == [{'id': initial_state.id, 'title': initial_state.title}]
+    resp = client.post('/api/posts', json={'title': 'example two', 'content': 'content'})
+    assert resp.status_code == 201
+    resp = client.get('/api/posts-suggest', params={'q': 'example tw'})
+    assert [post['title'] for post in resp.json()] == ['example two']
+
+def test_patch_post(initial_state):
+    post_id = initial_state.id
+    resp = client.patch(f'/api/posts/{post_id}', json={'content': 'patched content'})
+    assert resp.status_code == 200
+    data = resp.json()
+    assert data['content'] == 'patched content'
+    assert data['title'] == initial_state.title
+    resp = client.patch('/api/posts/999', json={'content': 'patched content'})
+    assert resp.status_code == 404
+
+def test_edit_post_other_user(initial_state, db_session):
+    # The mocked user is saved with an explicit id, the sequence doesn't know it
+    other_user = User(id=USER_MOCK['id'] + 1, email='other@faj.com', name='other')
+    db_session.add(other_user)
+    db_session.commit()
+    post = Posts(title='other title', content='other content', user_id=other_user.id)
+    db_session.add(post)
+    db_session.commit()
+    resp = client.patch(f'/api/posts/{post.id}', json={'content': 'patched content'})
+    assert resp.status_code == 403
+    resp = client.delete(f'/api/posts/{post.id}')
+    assert resp.status_code == 403
+
+def test_post_create_idempotency_key(initial_state):
+    data = {'title': 'idempotent title', 'content': 'some content'}
+    headers = {'Idempotency-Key': 'create-post-1'}
+    first = client.post('/api/posts', json=data, headers=headers)
+    assert first.status_code == 201
+    retry = client.post('/api/posts', json=data, headers=headers)
+    assert retry.status_code == 201
+    assert retry.json()['id'] == first.json()['id']
+    db = TestingSession()
+    assert db.query(Posts).filter(Posts.title == data['title']).count() == 1
+    db.close()
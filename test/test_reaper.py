@@ -0,0 +1,80 @@
+"""
+    Test for the reaper of orphaned images
+"""
+from datetime import datetime, timezone
+from test.utils import *
+from database import services
+from database.services import (get_db, get_user_by_token)
+from database.models import (Posts, OrphanedImage)
+from database.reaper import (reap_orphaned_images, reconcile_images)
+
+app.dependency_overrides[get_db] = override_get_db
+app.dependency_overrides[get_user_by_token] = override_get_current_user
+
+IMAGE = 'https://bucket.s3.amazonaws.com/abcdefghijk.png'
+
+
+class FakeS3:
+    """
+        Local stand-in for the S3 client
+    """
+    def __init__(self, keys=None, failed=None):
+        self.keys = keys or []
+        self.failed = failed or []
+        self.deleted = []
+
+    def delete_objects(self, Bucket, Delete):
+        keys = [item['Key'] for item in Delete['Objects']]
+        self.deleted.extend(key for key in keys if key not in self.failed)
+        return {'Errors': [{'Key': key, 'Message': 'AccessDenied'} for key in self.failed]}
+
+    def get_paginator(self, name):
+        return self
+
+    def paginate(self, Bucket):
+        old = datetime(2020, 1, 1, tzinfo=timezone.utc)
+        return [{'Contents': [{'Key': key, 'LastModified': old} for key in self.keys]}]
+
+
+def test_delete_post_queue_and_reap_image(initial_state, monkeypatch):
+    monkeypatch.setattr(services, 'BUCKET_NAME', 'bucket')
+    db = TestingSession()
+    db.query(Posts).filter(Posts.id == initial_state.id).update({'image': IMAGE})
+    db.commit()
+    resp = client.delete(f'/api/posts/{initial_state.id}')
+    assert resp.status_code == 200
+    assert [row.image for row in db.query(OrphanedImage)] == [IMAGE]
+    fake_s3 = FakeS3()
+    metrics = reap_orphaned_images(db, fake_s3)
+    assert fake_s3.deleted == ['abcdefghijk.png']
+    assert metrics['deleted'] == 1
+    assert db.query(OrphanedImage).count() == 0
+    db.close()
+
+
+def test_reaper_retries_failed_keys(initial_state, monkeypatch):
+    monkeypatch.setattr(services, 'BUCKET_NAME', 'bucket')
+    db = TestingSession()
+    db.add(OrphanedImage(image=IMAGE))
+    # Images of other hosts are dropped from the queue
+    db.add(OrphanedImage(image='https://example.com/image.png'))
+    db.commit()
+    metrics = reap_orphaned_images(db, FakeS3(failed=['abcdefghijk.png']))
+    assert metrics['failed'] == 1
+    assert metrics['skipped'] == 1
+    row = db.query(OrphanedImage).one()
+    assert row.attempts == 1
+    db.close()
+
+
+def test_reconcile_queue_unused_keys(initial_state, monkeypatch):
+    monkeypatch.setattr(services, 'BUCKET_NAME', 'bucket')
+    db = TestingSession()
+    db.query(Posts).filter(Posts.id == initial_state.id).update({'image': IMAGE})
+    db.commit()
+    fake_s3 = FakeS3(keys=['abcdefghijk.png', 'orphan.png'])
+    assert reconcile_images(db, fake_s3, dry_run=True)['orphans'] == 1
+    assert db.query(OrphanedImage).count() == 0
+    reconcile_images(db, fake_s3)
+    assert [row.image for row in db.query(OrphanedImage)] == ['https://bucket.s3.amazonaws.com/orphan.png']
+    db.close()
@@ -0,0 +1,38 @@
+"""
+    Test for the read replica routing
+"""
+from fastapi import FastAPI, Depends
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker, Session
+from database import services
+from database.services import (get_db, get_read_db, PRIMARY_PIN_COOKIE)
+
+replica_engine = create_engine("sqlite://")
+ReplicaSession = sessionmaker(autocommit=False, autoflush=False, bind=replica_engine)
+
+test_app = FastAPI()
+
+@test_app.get('/read')
+def read(db: Session = Depends(get_read_db)):
+    return {"replica": db.get_bind() is replica_engine}
+
+@test_app.post('/write')
+def write(db: Session = Depends(get_db)):
+    return {"replica": db.get_bind() is replica_engine}
+
+
+def test_read_without_replicas():
+    client = TestClient(test_app)
+    assert client.get('/read').json() == {"replica": False}
+
+
+def test_read_from_replica_and_pin_after_write(monkeypatch):
+    monkeypatch.setattr(services, 'get_replica_session', ReplicaSession)
+    client = TestClient(test_app)
+    assert client.get('/read').json() == {"replica": True}
+    resp = client.post('/write')
+    assert resp.json() == {"replica": False}
+    assert PRIMARY_PIN_COOKIE in resp.cookies
+    # Read your writes, the client is pinned to the primary
+    assert client.get('/read').json() == {"replica": False}
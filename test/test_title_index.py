@@ -0,0 +1,30 @@
+"""
+    Test for the prefix index of the post titles
+"""
+from database.title_index import TitleIndex
+
+
+def test_search_by_prefix():
+    index = TitleIndex()
+    index.build([(1, 'FastAPI on Lambda'), (2, 'fastapi tips'), (3, 'Django'), (4, None)])
+    assert index.search('fast') == [(1, 'FastAPI on Lambda'), (2, 'fastapi tips')]
+    assert index.search('fast', limit=1) == [(1, 'FastAPI on Lambda')]
+    assert index.search('flask') == []
+
+
+def test_incremental_updates():
+    index = TitleIndex()
+    index.build([(1, 'FastAPI on Lambda')])
+    index.add(2, 'Fast uploads')
+    index.add(1, 'Lambda layers')
+    assert index.search('fast') == [(2, 'Fast uploads')]
+    index.remove(2)
+    assert index.search('fast') == []
+    assert index.search('lambda') == [(1, 'Lambda layers')]
+
+
+def test_too_many_posts_uses_database():
+    index = TitleIndex(max_size=1)
+    assert not index.build([(1, 'one'), (2, 'two')])
+    assert not index.is_built
+    assert not index.needs_build()
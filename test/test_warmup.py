@@ -0,0 +1,25 @@
+"""
+    Test for the lambda warm-up fast path
+"""
+import app as app_module
+from database.services import is_warm_up_event
+
+
+def test_is_warm_up_event():
+    assert is_warm_up_event({"source": "aws.events", "detail-type": "Scheduled Event"})
+    assert is_warm_up_event({"warmer": True})
+    assert not is_warm_up_event({"httpMethod": "GET", "path": "/"})
+    assert not is_warm_up_event(None)
+
+
+def test_handler_answers_warm_up_without_asgi(monkeypatch):
+    calls = []
+    def fake_warm_up():
+        calls.append(1)
+        return {"warm": True}
+    def fake_mangum_handler(event, context):
+        raise AssertionError("The ASGI stack must not run")
+    monkeypatch.setattr(app_module, 'warm_up_connections', fake_warm_up)
+    monkeypatch.setattr(app_module, 'mangum_handler', fake_mangum_handler)
+    assert app_module.handler({"source": "aws.events"}, None) == {"warm": True}
+    assert calls == [1]
@@ -9,7 +9,7 @@ from fastapi.testclient import TestClient
 from app import app
 from database.database import baseModel
 from datetime import datetime
-from database.models import (Posts, User, RefreshToken)
+from database.models import (Posts, User, RefreshToken, IdempotencyKey, OrphanedImage)
 from pydantic_models.schemas import UserResponse
 
 client = TestClient(app)
@@ -68,6 +68,8 @@ def initial_state(db_session):
     yield post
     # Delete everything
     db.query(RefreshToken).delete()
+    db.query(IdempotencyKey).delete()
+    db.query(OrphanedImage).delete()
     db.query(Posts).delete()
     db.query(User).delete()
     with engine.connect() as connection: